@@ -1,3 +1,5 @@
+import functools
+import string
 import sys
 import modal
 from pydantic import BaseModel
@@ -8,6 +10,15 @@ class VariantRequest(BaseModel):
     genome: str
     chromosome: str
 
+class BatchVariant(BaseModel):
+    variant_position: int
+    alternative: str
+
+class VariantBatchRequest(BaseModel):
+    variants: list[BatchVariant]
+    genome: str
+    chromosome: str
+
 evo2_image = (
     modal.Image.from_registry(
         "nvidia/cuda:12.4.0-devel-ubuntu22.04", add_python="3.11"
@@ -37,6 +48,25 @@ evo2_image = (
     .run_commands("pip uninstall -y transformer-engine transformer_engine")
     .run_commands("pip install 'transformer_engine[pytorch]==1.13' --no-build-isolation")
     .pip_install_from_requirements("requirements.txt")
+    # Convert the BRCA1 annotations to parquet once, with columns already
+    # selected and renamed, so containers never parse the xlsx
+    .run_commands(
+        "python -c \"import pandas as pd; "
+        "df = pd.read_excel('/evo2/notebooks/brca1/41586_2018_461_MOESM3_ESM.xlsx', header=2); "
+        "df = df[['chromosome', 'position (hg19)', 'reference', 'alt', 'function.score.mean', 'func.class']]; "
+        "df.columns = ['chrom', 'pos', 'ref', 'alt', 'score', 'class']; "
+        "df.to_parquet('/evo2/notebooks/brca1/brca1.parquet')\""
+    )
+    # Decompress and index chr17 once so containers can read windows straight
+    # from disk
+    .run_commands(
+        "gunzip -k /evo2/notebooks/brca1/GRCh37.p13_chr17.fna.gz",
+        "python -c \"import pyfaidx; pyfaidx.Fasta('/evo2/notebooks/brca1/GRCh37.p13_chr17.fna')\"",
+    )
+    # Bake the Evo2 weights into the image so containers read them from local
+    # disk; the hf_cache volume is left for our own cached artifacts
+    .env({"HF_HOME": "/opt/weights"})
+    .run_commands("python -c 'from evo2 import Evo2; Evo2(\"evo2_7b\")'", gpu="H100")
 )
 
 app = modal.App("variant-analysis-evo2", image=evo2_image)
@@ -44,236 +74,501 @@ app = modal.App("variant-analysis-evo2", image=evo2_image)
 volume = modal.Volume.from_name("hf_cache", create_if_missing=True)
 mount_path = "/root/.cache/huggingface"
 
-@app.function(gpu="H100", volumes={mount_path: volume}, timeout=1000)
-def run_brca1_analysis():
-    import base64
-    from io import BytesIO
-    from Bio import SeqIO
-    import gzip
-    import matplotlib.pyplot as plt
+# Sequences per forward pass when scoring; 8192bp windows with Evo2-7B fit
+# comfortably on an H100 80GB at this size
+SCORING_BATCH_SIZE = 8
+
+def score_sequences_batched(model, seqs, batch_size=SCORING_BATCH_SIZE):
     import numpy as np
-    import pandas as pd
-    import os
-    import seaborn as sns
-    from sklearn.metrics import roc_auc_score, roc_curve
+    import torch
+
+    # Group sequences of equal length so each batch pads as little as possible,
+    # then restore the caller's order
+    order = sorted(range(len(seqs)), key=lambda i: len(seqs[i]))
+    with torch.inference_mode():
+        sorted_scores = model.score_sequences(
+            [seqs[i] for i in order], batch_size=batch_size)
+
+    # score_sequences only returns a list of floats, so fill the result array
+    # straight from it rather than building an intermediate list
+    scores = np.empty(len(seqs), dtype=np.float64)
+    scores[order] = np.fromiter(sorted_scores, dtype=np.float64, count=len(seqs))
+    return scores
+
+# Off until the graph path has been validated on an H100: Evo2's Transformer
+# Engine FP8 layers keep scaling state that torch.cuda.make_graphed_callables
+# manages and plain torch.cuda.graph capture, used below, does not
+USE_CUDA_GRAPHS = False
+
+# Each captured graph pins its own activation pool for a full batch of long
+# windows (BRCA1 windows are 8192bp, endpoint windows 8193bp). That cost is not
+# measured yet, so only the first shape seen is graphed; others run eagerly
+MAX_CUDA_GRAPHS = 1
+
+# Largest per-sequence difference allowed between graph replay and Evo2's own
+# scores. Both run the same bf16 arithmetic, so only kernel selection can make
+# them differ; 1e-5 is ~1% of the calibrated class stds
+GRAPH_SCORE_ATOL = 1e-5
+
+class GraphedEvo2Scorer:
+    # Drop-in for Evo2.score_sequences that records one forward pass per
+    # (batch size, sequence length) as a CUDA graph and replays it for every
+    # later full batch of that shape, skipping per-kernel launch overhead.
+    # Partial or mixed-length batches run eagerly through the wrapped model.
+    # A shape whose capture fails or does not reproduce Evo2's scores is
+    # marked as failed, logged once, and scored eagerly from then on.
+
+    def __init__(self, model, device="cuda:0"):
+        self.model = model
+        self.device = device
+        self.graphs = {}
+
+    def forward_logprobs(self, input_ids):
+        import torch
+
+        # Mirrors evo2.scoring: the inner StripedHyena returns
+        # (logits, inference_params), log_softmax runs in the model's native
+        # dtype and only the gathered token log-probs are cast to float
+        logits, _ = self.model.model.forward(input_ids)
+        logprobs = torch.log_softmax(logits, dim=-1)[:, :-1]
+        token_logprobs = torch.gather(
+            logprobs, 2, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+        return token_logprobs.float()
+
+    def reduce_scores(self, token_logprobs):
+        import numpy as np
+
+        # Same float32 np.mean reduction Evo2 applies on the host
+        return [np.mean(row) for row in token_logprobs.cpu().numpy()]
+
+    def tokenize(self, seqs):
+        import numpy as np
+        import torch
+
+        return torch.from_numpy(np.array(
+            [self.model.tokenizer.tokenize(seq) for seq in seqs], dtype=np.int64))
+
+    def capture(self, seqs):
+        import numpy as np
+        import torch
+
+        static_input = self.tokenize(seqs).to(self.device)
+
+        # Warm up on a side stream so lazy initialization is not recorded
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.forward_logprobs(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_logprobs = self.forward_logprobs(static_input)
+
+        graph.replay()
+        graphed_scores = np.asarray(self.reduce_scores(static_logprobs))
+        eager_scores = np.asarray(
+            self.model.score_sequences(seqs, batch_size=len(seqs)))
+        max_diff = float(np.abs(graphed_scores - eager_scores).max())
+        if max_diff > GRAPH_SCORE_ATOL:
+            print(
+                f"Warning: CUDA graph scores for batch shape {tuple(static_input.shape)} differ from Evo2 by {max_diff:.3g} (> {GRAPH_SCORE_ATOL}), scoring this shape eagerly")
+            return None
+
+        print(
+            f"Captured CUDA graph for batch shape {tuple(static_input.shape)}, max difference from Evo2: {max_diff:.3g}")
+
+        return graph, static_input, static_logprobs
+
+    def score_sequences(self, seqs, batch_size=SCORING_BATCH_SIZE):
+        scores = []
+        replayed_batches = 0
+        eager_batches = 0
+
+        for i in range(0, len(seqs), batch_size):
+            batch = seqs[i:i + batch_size]
+            seq_lengths = {len(seq) for seq in batch}
+
+            shape = (batch_size, seq_lengths.pop()) if len(seq_lengths) == 1 else None
+            if (shape is not None and len(batch) == batch_size
+                    and shape not in self.graphs and len(self.graphs) < MAX_CUDA_GRAPHS):
+                print(f"Capturing CUDA graph for batch shape {shape}...")
+                try:
+                    self.graphs[shape] = self.capture(batch)
+                except RuntimeError as e:
+                    # CUDA and capture errors surface as RuntimeError; mark the
+                    # shape so the capture is never retried
+                    print(
+                        f"Warning: CUDA graph capture failed for batch shape {shape}, scoring this shape eagerly: {e}")
+                    self.graphs[shape] = None
+
+            captured = self.graphs.get(shape) if len(batch) == batch_size else None
+            if captured is None:
+                scores.extend(self.model.score_sequences(
+                    batch, batch_size=len(batch)))
+                eager_batches += 1
+                continue
+
+            graph, static_input, static_logprobs = captured
+            static_input.copy_(self.tokenize(batch))
+            graph.replay()
+            scores.extend(self.reduce_scores(static_logprobs))
+            replayed_batches += 1
 
+        print(
+            f"Scored {replayed_batches} batches by CUDA graph replay, {eager_batches} eagerly")
+
+        return scores
+
+def load_model():
+    import torch
     from evo2 import Evo2
 
-    WINDOW_SIZE = 8192
+    # Let any fp32 matmuls outside Transformer Engine run on TF32 tensor cores
+    torch.set_float32_matmul_precision('high')
 
     print("Loading evo2 model...")
     model = Evo2('evo2_7b')
+    model.model.eval()
     print("Evo2 model loaded")
 
-    brca1_df = pd.read_excel(
-        '/evo2/notebooks/brca1/41586_2018_461_MOESM3_ESM.xlsx',
-        header=2,
-    )
-    brca1_df = brca1_df[[
-        'chromosome', 'position (hg19)', 'reference', 'alt', 'function.score.mean', 'func.class',
-    ]]
-
-    brca1_df.rename(columns={
-        'chromosome': 'chrom',
-        'position (hg19)': 'pos',
-        'reference': 'ref',
-        'alt': 'alt',
-        'function.score.mean': 'score',
-        'func.class': 'class',
-    }, inplace=True)
-
-    # Convert to two-class system
-    brca1_df['class'] = brca1_df['class'].replace(['FUNC', 'INT'], 'FUNC/INT')
+    return model
 
-    with gzip.open('/evo2/notebooks/brca1/GRCh37.p13_chr17.fna.gz', "rt") as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            seq_chr17 = str(record.seq)
-            break
+def roc_auc_youden(y_true, scores):
+    import numpy as np
 
-    # Build mappings of unique reference sequences
-    ref_seqs = []
-    ref_seq_to_index = {}
+    # One descending sort yields every ROC point; as in sklearn's roc_curve,
+    # each distinct score is a threshold and the last index of a tie run
+    # carries its cumulative counts
+    order = np.argsort(-scores, kind="mergesort")
+    sorted_scores = scores[order]
+    threshold_idxs = np.r_[np.flatnonzero(np.diff(sorted_scores)), len(scores) - 1]
 
-    # Parse sequences and store indexes
-    ref_seq_indexes = []
-    var_seqs = []
+    tps = np.cumsum(y_true[order])[threshold_idxs]
+    fps = threshold_idxs + 1 - tps
+    tpr = np.r_[0, tps / tps[-1]]
+    fpr = np.r_[0, fps / fps[-1]]
 
-    brca1_subset = brca1_df.iloc[:500].copy()
+    auroc = np.trapz(tpr, fpr)
 
-    for _, row in brca1_subset.iterrows():
-        p = row["pos"] - 1  # Convert to 0-indexed position
-        full_seq = seq_chr17
+    # Youden's J; skip the (0, 0) origin, which has no finite threshold
+    optimal_idx = (tpr[1:] - fpr[1:]).argmax()
 
-        ref_seq_start = max(0, p - WINDOW_SIZE//2)
-        ref_seq_end = min(len(full_seq), p + WINDOW_SIZE//2)
-        ref_seq = seq_chr17[ref_seq_start:ref_seq_end]
-        snv_pos_in_ref = min(WINDOW_SIZE//2, p)
-        var_seq = ref_seq[:snv_pos_in_ref] + \
-            row["alt"] + ref_seq[snv_pos_in_ref+1:]
+    return auroc, sorted_scores[threshold_idxs[optimal_idx]]
 
-        # Get or create index for reference sequence
-        if ref_seq not in ref_seq_to_index:
-            ref_seq_to_index[ref_seq] = len(ref_seqs)
-            ref_seqs.append(ref_seq)
+def gather_windows(seq_arr, positions, window_size):
+    import numpy as np
 
-        ref_seq_indexes.append(ref_seq_to_index[ref_seq])
-        var_seqs.append(var_seq)
+    # Windows that run off either end of the chromosome are padded with N, so
+    # every window is exactly window_size long with its position at the center
+    # and batches have one fixed, tensor-core friendly shape
+    offsets = positions[:, None] - window_size//2 + np.arange(window_size)
+    in_bounds = (offsets >= 0) & (offsets < len(seq_arr))
+    return np.where(
+        in_bounds,
+        seq_arr[np.clip(offsets, 0, len(seq_arr) - 1)],
+        np.uint8(ord("N")),
+    )
 
-    ref_seq_indexes = np.array(ref_seq_indexes)
+# Reference data shipped with the evo2 repository (GRCh37 == UCSC hg19)
+CHR17_FASTA_PATH = "/evo2/notebooks/brca1/GRCh37.p13_chr17.fna"
+CHR17_GENOME = "hg19"
+CHR17_CHROMOSOME = "chr17"
+# Built from the paper's supplementary xlsx during the image build
+BRCA1_PARQUET_PATH = "/evo2/notebooks/brca1/brca1.parquet"
 
-    print(
-        f'Scoring likelihoods of {len(ref_seqs)} reference sequences with Evo 2...')
-    ref_scores = model.score_sequences(ref_seqs)
+@functools.lru_cache(maxsize=None)
+def load_chr17():
+    import pyfaidx
 
-    print(
-        f'Scoring likelihoods of {len(var_seqs)} variant sequences with Evo 2...')
-    var_scores = model.score_sequences(var_seqs)
+    # Indexed, uncompressed FASTA prepared at image build time; slices are read
+    # from disk on demand instead of holding the whole chromosome in memory
+    fasta = pyfaidx.Fasta(CHR17_FASTA_PATH, as_raw=True)
+    return fasta[next(iter(fasta.keys()))]
 
-    # Subtract score of corresponding reference sequences from scores of variant sequences
-    delta_scores = np.array(var_scores) - np.array(ref_scores)[ref_seq_indexes]
+@functools.lru_cache(maxsize=None)
+def load_brca1_annotations():
+    import pandas as pd
 
-    # Add delta scores to dataframe
-    brca1_subset[f'evo2_delta_score'] = delta_scores
+    brca1_df = pd.read_parquet(BRCA1_PARQUET_PATH)
 
-    y_true = (brca1_subset['class'] == 'LOF')
-    auroc = roc_auc_score(y_true, -brca1_subset['evo2_delta_score'])
+    # Convert to two-class system
+    brca1_df['class'] = brca1_df['class'].replace(['FUNC', 'INT'], 'FUNC/INT')
 
-    # --- Calculate threshold START
-    y_true = (brca1_subset["class"] == "LOF")
+    return brca1_df
 
-    fpr, tpr, thresholds = roc_curve(y_true, -brca1_subset["evo2_delta_score"])
+# Written by calibrate_brca1_thresholds and read by every Evo2Model container
+CALIBRATION_PATH = f"{mount_path}/evo2_calibration.json"
 
-    optimal_idx = (tpr - fpr).argmax()
+# Containers re-read the calibration from the volume at most this often, so
+# ones not reached by reload_calibration still pick up a new one
+CALIBRATION_REFRESH_SECONDS = 300
 
-    optimal_threshold = -thresholds[optimal_idx]
+# Used until a calibration has been written to the volume
+DEFAULT_CALIBRATION = {
+    "threshold": -0.0009178519,
+    "lof_std": 0.0015140239,
+    "func_std": 0.0009016589,
+}
 
-    lof_scores = brca1_subset.loc[brca1_subset["class"]
-                                    == "LOF", "evo2_delta_score"]
-    func_scores = brca1_subset.loc[brca1_subset["class"]
-                                    == "FUNC/INT", "evo2_delta_score"]
+def load_calibration():
+    import json
+    import os
 
-    lof_std = lof_scores.std()
-    func_std = func_scores.std()
+    if not os.path.exists(CALIBRATION_PATH):
+        return dict(DEFAULT_CALIBRATION)
 
-    confidence_params = {
-        "threshold": optimal_threshold,
-        "lof_std": lof_std,
-        "func_std": func_std
-    }
+    with open(CALIBRATION_PATH) as f:
+        return json.load(f)
 
-    print("Confidence params:", confidence_params)
+@app.function(volumes={mount_path: volume})
+def calibrate_brca1_thresholds():
+    import json
 
-    # --- Calculate threshold END
+    print("Calibrating variant thresholds on BRCA1 with Evo2...")
 
-    plt.figure(figsize=(4, 2))
+    result = Evo2Model().run_brca1_analysis.remote(calibrate=True)
 
-    # Plot stripplot of distributions
-    p = sns.stripplot(
-        data=brca1_subset,
-        x='evo2_delta_score',
-        y='class',
-        hue='class',
-        order=['FUNC/INT', 'LOF'],
-        palette=['#777777', 'C3'],
-        size=2,
-        jitter=0.3,
-    )
+    print("AUROC:", result["auroc"])
+    print("Confidence params:", result["confidence_params"])
 
-    # Mark medians from each distribution
-    sns.boxplot(showmeans=True,
-                meanline=True,
-                meanprops={'visible': False},
-                medianprops={'color': 'k', 'ls': '-', 'lw': 2},
-                whiskerprops={'visible': False},
-                zorder=10,
-                x="evo2_delta_score",
-                y="class",
-                data=brca1_subset,
-                showfliers=False,
-                showbox=False,
-                showcaps=False,
-                ax=p)
-    plt.xlabel('Delta likelihood score, Evo 2')
-    plt.ylabel('BRCA1 SNV class')
-    plt.tight_layout()
+    with open(CALIBRATION_PATH, "w") as f:
+        json.dump(result["confidence_params"], f)
+    volume.commit()
 
-    buffer = BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plot_data = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    print(f"Calibration written to {CALIBRATION_PATH}")
 
-    return {'variants': brca1_subset.to_dict(orient="records"), "plot": plot_data, "auroc": auroc}
+    # The warm container never restarts, so tell it to pick up the new values
+    calibration = Evo2Model().reload_calibration.remote()
+    print("Evo2Model now using calibration:", calibration)
 
+# Plotting runs here on a CPU container so the H100 is released as soon as
+# scoring finishes
 @app.function()
 def brca1_example():
-    import base64
     from io import BytesIO
+    import matplotlib
+    matplotlib.use("Agg")
     import matplotlib.pyplot as plt
-    import matplotlib.image as mpimg
+    import numpy as np
 
     print("Running BRCA1 variant analysis with Evo2...")
 
     # Run inference
-    result = run_brca1_analysis.remote()
+    result = Evo2Model().run_brca1_analysis.remote()
 
-    if "plot" in result:
-        plot_data = base64.b64decode(result["plot"])
-        with open("brca1_analysis_plot.png", "wb") as f:
-            f.write(plot_data)
+    print("AUROC:", result["auroc"])
 
-        img = mpimg.imread(BytesIO(plot_data))
-        plt.figure(figsize=(10, 5))
-        plt.imshow(img)
-        plt.axis("off")
-        plt.show()
+    delta_scores = result["delta_scores"]
+    classes = result["classes"]
 
-def get_genome_sequence(position, genome: str, chromosome: str, window_size=8192):
-    import requests
+    rng = np.random.default_rng(0)
+    plt.figure(figsize=(4, 2))
 
+    # Plot jittered strips of each distribution and mark their medians
+    order = ['FUNC/INT', 'LOF']
+    for class_idx, (label, color) in enumerate(zip(order, ['#777777', 'C3'])):
+        class_scores = delta_scores[classes == label]
+        y_jitter = rng.uniform(-0.3, 0.3, size=len(class_scores))
+        plt.scatter(class_scores, class_idx + y_jitter, s=4, c=color)
+        if len(class_scores):
+            plt.vlines(np.median(class_scores), class_idx - 0.4, class_idx + 0.4,
+                       colors='k', linestyles='-', lw=2, zorder=10)
+
+    plt.yticks(range(len(order)), order)
+    plt.ylim(len(order) - 0.5, -0.5)
+    plt.xlabel('Delta likelihood score, Evo 2')
+    plt.ylabel('BRCA1 SNV class')
+    plt.tight_layout()
+
+    # The container's filesystem is discarded on exit, so hand the PNG back
+    buffer = BytesIO()
+    plt.savefig(buffer, format="png")
+    plt.close()
+
+    return buffer.getvalue()
+
+@app.local_entrypoint()
+def save_brca1_plot():
+    plot_data = brca1_example.remote()
+
+    with open("brca1_analysis_plot.png", "wb") as f:
+        f.write(plot_data)
+
+    print("Saved BRCA1 plot to brca1_analysis_plot.png")
+
+# Byte-level table for upper-casing soft-masked bases; bytes.translate is a
+# single C pass, unlike the Unicode-aware str.upper
+UPPERCASE_TABLE = bytes.maketrans(
+    string.ascii_lowercase.encode("ascii"), string.ascii_uppercase.encode("ascii"))
+
+def get_genome_window(position, window_size=8192):
     half_window = window_size // 2
     start = max(0, position - 1 - half_window)
     end = position - 1 + half_window + 1
+    return start, end
 
-    print(
-        f"Fetching {window_size}bp window around position {position} from UCSC API..")
-    print(f"Coordinates: {chromosome}:{start}-{end} ({genome})")
-
-    api_url = f"https://api.genome.ucsc.edu/getData/sequence?genome={genome};chrom={chromosome};start={start};end={end}"
-    response = requests.get(api_url)
+def get_genome_api_url(genome: str, chromosome: str, start, end):
+    return f"https://api.genome.ucsc.edu/getData/sequence?genome={genome};chrom={chromosome};start={start};end={end}"
 
-    if response.status_code != 200:
-        raise Exception(
-            f"Failed to fetch genome sequence from UCSC API: {response.status_code}")
-
-    genome_data = response.json()
+def parse_genome_sequence(genome_data, start, end):
+    import numpy as np
 
     if "dna" not in genome_data:
         error = genome_data.get("error", "Unknown error")
         raise Exception(f"UCSC API error: {error}")
 
-    sequence = genome_data.get("dna", "").upper()
+    sequence = np.frombuffer(genome_data.get("dna", "").encode("ascii").translate(
+        UPPERCASE_TABLE), dtype=np.uint8)
     expected_length = end - start
     if len(sequence) != expected_length:
         print(
             f"Warning: received sequence length ({len(sequence)}) differs from expected ({expected_length})")
 
+    return sequence
+
+# Status codes retried by both UCSC clients, with exponential backoff
+UCSC_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Reuse TLS connections to the UCSC API across requests and retry
+    # transient failures with a short backoff
+    session = requests.Session()
+    session.headers.update({"Accept-Encoding": "gzip"})
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=UCSC_RETRY_STATUSES,
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+
+    return session
+
+def get_genome_sequence(position, genome: str, chromosome: str, window_size=8192, session=None):
+    import requests
+
+    http = session if session is not None else requests
+
+    start, end = get_genome_window(position, window_size)
+
+    print(
+        f"Fetching {window_size}bp window around position {position} from UCSC API..")
+    print(f"Coordinates: {chromosome}:{start}-{end} ({genome})")
+
+    response = http.get(
+        get_genome_api_url(genome, chromosome, start, end), timeout=10)
+
+    if response.status_code != 200:
+        raise Exception(
+            f"Failed to fetch genome sequence from UCSC API: {response.status_code}")
+
+    sequence = parse_genome_sequence(response.json(), start, end)
+
     print(
         f"Loaded reference genome sequence window (length: {len(sequence)} bases)")
 
     return sequence, start
 
-def analyze_variant(relative_pos_in_window, reference, alternative, window_seq, model):
-    var_seq = window_seq[:relative_pos_in_window] + \
-        alternative + window_seq[relative_pos_in_window+1:]
+# Variants scored per step of the batched endpoint; the windows for the next
+# step are fetched while the current one is on the GPU
+VARIANT_CHUNK_SIZE = 32
 
-    ref_score = model.score_sequences([window_seq])[0]
-    var_score = model.score_sequences([var_seq])[0]
+# Cap on in-flight UCSC requests so a large batch does not get throttled
+UCSC_MAX_CONCURRENT_REQUESTS = 8
 
-    delta_score = var_score - ref_score
+def create_async_http_client():
+    import httpx
 
-    threshold = -0.0009178519
-    lof_std = 0.0015140239
-    func_std = 0.0009016589
+    # One pooled client per container so batched requests reuse TLS
+    # connections; the transport retries connection failures
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(retries=3),
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+        timeout=30,
+    )
+
+async def get_genome_sequences(positions, genome: str, chromosome: str, window_size=8192, client=None):
+    import asyncio
+
+    semaphore = asyncio.Semaphore(UCSC_MAX_CONCURRENT_REQUESTS)
+
+    async def fetch(client, position):
+        start, end = get_genome_window(position, window_size)
+        url = get_genome_api_url(genome, chromosome, start, end)
+        async with semaphore:
+            for attempt in range(4):
+                response = await client.get(url)
+                if response.status_code not in UCSC_RETRY_STATUSES or attempt == 3:
+                    break
+                await asyncio.sleep(0.2 * 2 ** attempt)
+
+        if response.status_code != 200:
+            raise Exception(
+                f"Failed to fetch genome sequence from UCSC API: {response.status_code}")
+
+        return parse_genome_sequence(response.json(), start, end), start
+
+    print(
+        f"Fetching {len(positions)} {window_size}bp windows from UCSC API ({genome} {chromosome})..")
+
+    if client is not None:
+        return await asyncio.gather(*(fetch(client, position) for position in positions))
+
+    async with create_async_http_client() as client:
+        return await asyncio.gather(*(fetch(client, position) for position in positions))
+
+def get_local_genome_sequence(seq_record, position, window_size=8192):
+    import numpy as np
+
+    start, end = get_genome_window(position, window_size)
+    end = min(len(seq_record), end)
+
+    print(
+        f"Slicing {window_size}bp window around position {position} from local reference FASTA..")
+
+    # Match the case normalization applied to UCSC API responses
+    sequence = np.frombuffer(seq_record[start:end].encode("ascii").translate(
+        UPPERCASE_TABLE), dtype=np.uint8)
+
+    return sequence, start
+
+def locate_variant(variant_position, window_seq, seq_start):
+    relative_pos = variant_position - 1 - seq_start
+
+    if relative_pos < 0 or relative_pos >= len(window_seq):
+        raise ValueError(
+            f"Variant position {variant_position} is outside the fetched window (start={seq_start+1}, end={seq_start+len(window_seq)})")
+
+    return relative_pos, chr(window_seq[relative_pos])
+
+def decode_sequence(seq_arr):
+    # Evo2's tokenizer takes text and re-encodes it to uint8 itself
+    return seq_arr.tobytes().decode("ascii")
+
+def make_variant_sequence(window_seq, relative_pos_in_window, alternative):
+    if len(alternative) != 1:
+        raise ValueError(
+            f"Alternative allele must be a single base, got '{alternative}'")
+
+    # One byte write into a copy of the uint8 window
+    var_seq = window_seq.copy()
+    var_seq[relative_pos_in_window] = ord(alternative)
+    return var_seq
+
+def classify_variant(reference, alternative, delta_score, calibration):
+    threshold = calibration["threshold"]
+    lof_std = calibration["lof_std"]
+    func_std = calibration["func_std"]
 
     if delta_score < threshold:
         prediction = "Likely pathogenic"
@@ -290,17 +585,150 @@ def analyze_variant(relative_pos_in_window, reference, alternative, window_seq,
         "classification_confidence": float(confidence)
     }
 
-@app.cls(gpu="H100", volumes={mount_path: volume}, max_containers=3, retries=2, scaledown_window=120)
+def analyze_variant(relative_pos_in_window, reference, alternative, window_seq, model, calibration):
+    var_seq = make_variant_sequence(
+        window_seq, relative_pos_in_window, alternative)
+
+    # Score reference and variant together as one batch of two
+    ref_score, var_score = score_sequences_batched(
+        model, [decode_sequence(window_seq), decode_sequence(var_seq)])
+
+    delta_score = var_score - ref_score
+
+    return classify_variant(reference, alternative, delta_score, calibration)
+
+@app.cls(gpu="H100", volumes={mount_path: volume}, max_containers=3, min_containers=1, retries=2, scaledown_window=120, timeout=1000)
 class Evo2Model:
     @modal.enter()
     def load_evo2_model(self):
-        print("Loading evo2 model...")
-        from evo2 import Evo2
-        self.model = Evo2('evo2_7b')
-        print("Evo2 model loaded")
+        self.model = load_model()
+        self.scorer = GraphedEvo2Scorer(
+            self.model) if USE_CUDA_GRAPHS else self.model
+
+        self.seq_chr17 = load_chr17()
+        print("chr17 reference loaded")
+
+        self.http = create_http_session()
+        self.async_http = create_async_http_client()
+
+        self.refresh_calibration()
+        print("Calibration:", self.calibration)
+
+    def refresh_calibration(self):
+        import time
+
+        # Commits made by other containers are only visible after a reload
+        volume.reload()
+        self.calibration = load_calibration()
+        self.calibration_loaded_at = time.monotonic()
+
+    def maybe_refresh_calibration(self):
+        import time
+
+        if time.monotonic() - self.calibration_loaded_at > CALIBRATION_REFRESH_SECONDS:
+            self.refresh_calibration()
+
+    @modal.method()
+    def reload_calibration(self):
+        self.refresh_calibration()
+        print("Reloaded calibration:", self.calibration)
+        return self.calibration
+
+    @modal.exit()
+    async def close_http_clients(self):
+        self.http.close()
+        await self.async_http.aclose()
+
+    @modal.method()
+    def run_brca1_analysis(self, calibrate=False):
+        import numpy as np
+
+        WINDOW_SIZE = 8192
+
+        brca1_df = load_brca1_annotations()
+
+        brca1_subset = brca1_df.iloc[:500].copy()
+
+        positions = brca1_subset["pos"].to_numpy() - 1  # Convert to 0-indexed positions
+        alt_codes = np.frombuffer(
+            "".join(brca1_subset["alt"]).encode("ascii"), dtype=np.uint8)
+
+        # The reference genome is fixed, so identical coordinates mean identical
+        # windows: dedupe on position (and alt) instead of hashing whole windows
+        ref_positions, ref_seq_indexes = np.unique(positions, return_inverse=True)
+        var_keys, var_seq_indexes = np.unique(
+            positions * 256 + alt_codes, return_inverse=True)
+
+        # Read only the stretch of chr17 the windows cover; it is clamped to the
+        # chromosome, so anything outside it is padded exactly as before
+        span_start = max(0, int(positions.min()) - WINDOW_SIZE//2)
+        span_end = min(len(self.seq_chr17), int(positions.max()) + WINDOW_SIZE//2)
+        span_arr = np.frombuffer(
+            self.seq_chr17[span_start:span_end].encode("ascii"), dtype=np.uint8)
+
+        # Only the unique windows are ever materialized
+        refs2d = gather_windows(span_arr, ref_positions - span_start, WINDOW_SIZE)
+        vars2d = gather_windows(
+            span_arr, var_keys // 256 - span_start, WINDOW_SIZE)
+        vars2d[:, WINDOW_SIZE//2] = var_keys % 256
+
+        ref_seqs = [decode_sequence(row) for row in refs2d]
+        var_seqs = [decode_sequence(row) for row in vars2d]
+
+        print(
+            f'Scoring likelihoods of {len(ref_seqs)} reference and {len(var_seqs)} unique variant sequences with Evo 2...')
+        scores = score_sequences_batched(self.scorer, ref_seqs + var_seqs)
+        ref_scores = scores[:len(ref_seqs)]
+        var_scores = scores[len(ref_seqs):]
+
+        # Subtract score of corresponding reference sequences from scores of variant sequences
+        delta_scores = var_scores[var_seq_indexes] - ref_scores[ref_seq_indexes]
+
+        # Add delta scores to dataframe
+        brca1_subset[f'evo2_delta_score'] = delta_scores
+
+        # --- Calculate threshold START
+        y_true = (brca1_subset["class"] == "LOF").to_numpy()
+
+        auroc, optimal_threshold = roc_auc_youden(y_true, -delta_scores)
+
+        optimal_threshold = -optimal_threshold
+
+        lof_scores = brca1_subset.loc[brca1_subset["class"]
+                                        == "LOF", "evo2_delta_score"]
+        func_scores = brca1_subset.loc[brca1_subset["class"]
+                                        == "FUNC/INT", "evo2_delta_score"]
+
+        lof_std = lof_scores.std()
+        func_std = func_scores.std()
+
+        confidence_params = {
+            "threshold": float(optimal_threshold),
+            "lof_std": float(lof_std),
+            "func_std": float(func_std)
+        }
+
+        print("Confidence params:", confidence_params)
+
+        # --- Calculate threshold END
+
+        if calibrate:
+            return {"confidence_params": confidence_params, "auroc": float(auroc)}
+
+        # Plain arrays pickle through their buffers, far cheaper across the
+        # Modal boundary than one dict per row; callers rebuild a frame if needed
+        return {
+            "positions": brca1_subset["pos"].to_numpy(),
+            "delta_scores": delta_scores.astype(np.float32),
+            "classes": brca1_subset["class"].to_numpy(),
+            "auroc": float(auroc),
+            "confidence_params": confidence_params,
+        }
 
     @modal.fastapi_endpoint(method="POST")
     def analyze_single_variant(self, request: VariantRequest):
+        self.maybe_refresh_calibration()
+
         variant_position = request.variant_position
         alternative = request.alternative
         genome = request.genome
@@ -313,23 +741,26 @@ class Evo2Model:
 
         WINDOW_SIZE = 8192
 
-        window_seq, seq_start = get_genome_sequence(
-            position=variant_position,
-            genome=genome,
-            chromosome=chromosome,
-            window_size=WINDOW_SIZE
-        )
-
-        print(f"Fetched genome sequence window, first 100: {window_seq[:100]}")
-
-        relative_pos = variant_position - 1 - seq_start
+        if (genome, chromosome) == (CHR17_GENOME, CHR17_CHROMOSOME):
+            window_seq, seq_start = get_local_genome_sequence(
+                self.seq_chr17,
+                position=variant_position,
+                window_size=WINDOW_SIZE
+            )
+        else:
+            window_seq, seq_start = get_genome_sequence(
+                position=variant_position,
+                genome=genome,
+                chromosome=chromosome,
+                window_size=WINDOW_SIZE,
+                session=self.http
+            )
+
+        print(f"Fetched genome sequence window, first 100: {decode_sequence(window_seq[:100])}")
+
+        relative_pos, reference = locate_variant(
+            variant_position, window_seq, seq_start)
         print(f"Relative position within window: {relative_pos}")
-
-        if relative_pos < 0 or relative_pos >= len(window_seq):
-            raise ValueError(
-                f"Variant position {variant_position} is outside the fetched window (start={seq_start+1}, end={seq_start+len(window_seq)})")
-
-        reference = window_seq[relative_pos]
         print("Reference is: " + reference)
 
         # Analyze the variant
@@ -338,13 +769,126 @@ class Evo2Model:
             reference=reference,
             alternative=alternative,
             window_seq=window_seq,
-            model=self.model
+            model=self.model,
+            calibration=self.calibration
         )
 
         result["position"] = variant_position
 
         return result
 
+    async def get_windows(self, positions, genome, chromosome, window_size):
+        positions = sorted(set(positions))
+
+        if (genome, chromosome) == (CHR17_GENOME, CHR17_CHROMOSOME):
+            windows = [get_local_genome_sequence(self.seq_chr17, position, window_size)
+                       for position in positions]
+        else:
+            windows = await get_genome_sequences(
+                positions, genome, chromosome, window_size, client=self.async_http)
+
+        return dict(zip(positions, windows))
+
+    def analyze_windowed_variants(self, variants, windows):
+        # Each distinct reference window once plus every variant window, all
+        # scored in a single batched call
+        ref_seqs = []
+        ref_position_to_index = {}
+        ref_seq_indexes = []
+        var_seqs = []
+        references = []
+
+        for variant in variants:
+            window_seq, seq_start = windows[variant.variant_position]
+            relative_pos, reference = locate_variant(
+                variant.variant_position, window_seq, seq_start)
+
+            # Windows are centered on the variant, so the position identifies them
+            if variant.variant_position not in ref_position_to_index:
+                ref_position_to_index[variant.variant_position] = len(ref_seqs)
+                ref_seqs.append(decode_sequence(window_seq))
+
+            ref_seq_indexes.append(ref_position_to_index[variant.variant_position])
+            var_seqs.append(decode_sequence(make_variant_sequence(
+                window_seq, relative_pos, variant.alternative)))
+            references.append(reference)
+
+        print(
+            f'Scoring likelihoods of {len(ref_seqs)} reference and {len(var_seqs)} variant sequences with Evo 2...')
+        scores = score_sequences_batched(self.scorer, ref_seqs + var_seqs)
+        ref_scores = scores[:len(ref_seqs)]
+        var_scores = scores[len(ref_seqs):]
+
+        delta_scores = var_scores - ref_scores[ref_seq_indexes]
+
+        results = []
+        for variant, reference, delta_score in zip(variants, references, delta_scores):
+            result = classify_variant(
+                reference, variant.alternative, delta_score, self.calibration)
+            result["position"] = variant.variant_position
+            results.append(result)
+
+        return results
+
+    @modal.fastapi_endpoint(method="POST")
+    async def analyze_variants(self, request: VariantBatchRequest):
+        import asyncio
+        from fastapi import HTTPException
+
+        genome = request.genome
+        chromosome = request.chromosome
+
+        print("Genome:", genome)
+        print("Chromosome:", chromosome)
+        print("Variants:", len(request.variants))
+
+        # Reject bad input before any window is fetched or scored
+        for variant in request.variants:
+            if variant.variant_position < 1:
+                raise HTTPException(
+                    status_code=400, detail=f"Variant position must be 1 or greater, got {variant.variant_position}")
+            if len(variant.alternative) != 1 or variant.alternative not in "ACGT":
+                raise HTTPException(
+                    status_code=400, detail=f"Alternative allele must be one of A, C, G, T, got '{variant.alternative}'")
+
+        self.maybe_refresh_calibration()
+
+        WINDOW_SIZE = 8192
+
+        chunks = [request.variants[i:i + VARIANT_CHUNK_SIZE]
+                  for i in range(0, len(request.variants), VARIANT_CHUNK_SIZE)]
+
+        def fetch_windows(chunk):
+            return asyncio.create_task(self.get_windows(
+                [v.variant_position for v in chunk], genome, chromosome, WINDOW_SIZE))
+
+        # Fetch the windows for the next chunk while the current one is being
+        # scored on the GPU
+        results = []
+        next_windows = fetch_windows(chunks[0]) if chunks else None
+        try:
+            for i, chunk in enumerate(chunks):
+                windows = await next_windows
+                if i + 1 < len(chunks):
+                    next_windows = fetch_windows(chunks[i + 1])
+
+                # Score off the event loop so the prefetch above keeps running
+                try:
+                    results.extend(await asyncio.to_thread(
+                        self.analyze_windowed_variants, chunk, windows))
+                except ValueError as e:
+                    # e.g. a position past the end of the chromosome
+                    raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            # Stop a prefetch that will never be used, and retrieve the error
+            # of one that already failed so it is not reported as unhandled
+            if next_windows is not None:
+                next_windows.cancel()
+                if next_windows.done() and not next_windows.cancelled():
+                    next_windows.exception()
+
+        return results
+
 @app.local_entrypoint()
 def main():
     # Example of how you'd call the deployed Modal Function from your client